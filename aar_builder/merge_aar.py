@@ -56,16 +56,16 @@ flags.DEFINE_string(
 )
 
 
-def main(argv):
-  if len(argv) > 1:
-    raise app.UsageError('Too many command-line arguments.')
-  input_srcaars = FLAGS.inputs
-  if len(input_srcaars) <= 1:
-    raise app.UsageError(
-        'Input srcaars needs more than 1 entry, currently only %d.'.format(len(input_srcaars)))
+def merge(inputs, output):
+  """Merge the given srcaar files into one.
+
+    Args:
+      inputs: list of srcaar file paths to merge together.
+      output: file path of the merged srcaar file.
+  """
   # temp folder to exact input srcaar files in
   base_temp_dir = tempfile.mkdtemp()
-  for input in input_srcaars:
+  for input in inputs:
     if os.stat(input).st_size == 0:
       # Ignore empty aar file
       logging.debug("input %s is empty.", input)
@@ -78,7 +78,7 @@ def main(argv):
       zip_aar.extractall(base_temp_dir)
 
   # Create the output AAR.
-  output_aar_file = FLAGS.output
+  output_aar_file = output
   if os.path.exists(output_aar_file) and os.path.isfile(output_aar_file):
     # remove the existing srcaar with the output name.
     os.remove(output_aar_file)
@@ -95,6 +95,16 @@ def main(argv):
   logging.debug("Archived directory %s to %s", base_temp_dir, output_aar_file)
 
 
+def main(argv):
+  if len(argv) > 1:
+    raise app.UsageError('Too many command-line arguments.')
+  input_srcaars = FLAGS.inputs
+  if len(input_srcaars) <= 1:
+    raise app.UsageError(
+        'Input srcaars needs more than 1 entry, currently only %d.'.format(len(input_srcaars)))
+  merge(input_srcaars, FLAGS.output)
+
+
 if __name__ == '__main__':
   flags.mark_flag_as_required("inputs")
   flags.mark_flag_as_required("output")
@@ -19,18 +19,37 @@
 Example usage:
   python build_zips.py --platform=macos --apis=auth --targets=firestore
 """
+import concurrent.futures
+import functools
 import glob
+import hashlib
+import multiprocessing
 import os
 import shutil
+import struct
 import subprocess
 import zipfile
 import tempfile
 import threading
 import sys
+import zlib
 
 from absl import app, flags, logging
 
 SUPPORT_PLATFORMS = ("linux", "macos", "windows", "ios", "tvos", "android")
+
+# Number of parallel compile jobs to use for every cmake/make invocation.
+JOBS = str(multiprocessing.cpu_count())
+
+# Buffer/chunk size used when reading and writing the SDK zip files.
+ZIP_BUFFER_SIZE = 1024 * 1024
+
+# Deflate level for the entries this script compresses itself: the merged
+# srcaar/bundle files and archived temp trees. Entries copied from the
+# per-arch zips keep the bytes cpack produced and are not affected. The zips
+# written here are the shipped SDK artifacts, so default to the zlib default
+# level; override with FIREBASE_ZIP_LEVEL to trade size for CPU time.
+ZIP_COMPRESSION_LEVEL = int(os.getenv("FIREBASE_ZIP_LEVEL", "6"))
 SUPPORT_TARGETS = [
     "analytics", "app_check", "auth", "crashlytics", "database", "dynamic_links",
     "firestore", "functions", "installations", "messaging", "remote_config",
@@ -78,9 +97,6 @@ ANDROID_SUPPORT_ARCHITECTURE = ["armeabi-v7a", "arm64-v8a", "x86", "x86_64"]
 
 MACOS_SUPPORT_ARCHITECTURE = ["x86_64", "arm64"]
 
-g_target_architectures = []
-g_cpp_sdk_realpath = ""
-
 FLAGS = flags.FLAGS
 flags.DEFINE_string(
     'platform', None,
@@ -137,8 +153,7 @@ def get_build_path(platform, clean_build=False):
   platform_path = os.path.join(os.getcwd(), platform + "_unity")
   if os.path.exists(platform_path) and clean_build:
     shutil.rmtree(platform_path)
-  if not os.path.exists(platform_path):
-    os.makedirs(platform_path)
+  os.makedirs(platform_path, exist_ok=True)
   return platform_path
 
 
@@ -150,16 +165,15 @@ def get_cpp_folder_args(source_path):
       source_path: root source folder cd back.
 
     Returns:
-      cmake args with the folder path of local Firebase C++ SDK. 
-      Empty string if not found.
+      Tuple of (real path of the local Firebase C++ SDK, cmake arg with that
+      folder path). Empty strings if not found.
   """
-  global g_cpp_sdk_realpath
-  cpp_folder = os.path.join(os.getcwd(), "..", "firebase-cpp-sdk")
+  cpp_folder = os.path.join(source_path, "..", "firebase-cpp-sdk")
   if os.path.exists(cpp_folder):
-    g_cpp_sdk_realpath = os.path.realpath(cpp_folder)
-    return "-DFIREBASE_CPP_SDK_DIR=" + g_cpp_sdk_realpath
+    cpp_sdk_realpath = os.path.realpath(cpp_folder)
+    return cpp_sdk_realpath, "-DFIREBASE_CPP_SDK_DIR=" + cpp_sdk_realpath
   else:
-    return ""
+    return "", ""
 
 
 def get_unity_engine_folder_args(unity_root):
@@ -195,7 +209,7 @@ def get_targets_args(targets):
       targets = TVOS_SUPPORT_TARGETS
     else:
       if 'dynamic_links' in targets:
-        logging.warning("Dynamic Links is not supported on tvOS. " +
+        logging.warning("Dynamic Links is not supported on tvOS. "
           "Removing it from the api build list.")
         targets.remove('dynamic_links')
 
@@ -213,7 +227,7 @@ def get_targets_args(targets):
       else:
         result_args.append("-DFIREBASE_INCLUDE_" + target.upper() +
                            "=OFF")
-  logging.debug("get target args are:" + ",".join(result_args))
+  logging.debug("get target args are: %s", result_args)
   return result_args
 
 
@@ -248,7 +262,7 @@ def get_ios_args(source_path):
     Args:
       source_path: root source folder to find toolchain file.
     Returns:
-      camke args for iOS platform.
+      Tuple of (cmake args for iOS platform, list of target architectures).
   """
   result_args = []
   toolchain_path = os.path.join(source_path, "cmake", "unity_ios.cmake")
@@ -265,7 +279,6 @@ def get_ios_args(source_path):
   else:
     devices = SUPPORT_DEVICE
 
-  global g_target_architectures
   # check architecture input
   if (len(devices) > 1):
     archs_to_check = IOS_SUPPORT_ARCHITECTURE
@@ -277,14 +290,14 @@ def get_ios_args(source_path):
         raise app.UsageError(
             'Wrong architecture "{}" for device type {}, please pick from {}'.format(
                 arch, ",".join(devices), ",".join(archs_to_check)))
-    g_target_architectures = FLAGS.architecture
+    target_architectures = FLAGS.architecture
   else:
-    g_target_architectures = archs_to_check
+    target_architectures = archs_to_check
 
-  if len(g_target_architectures) != len(IOS_SUPPORT_ARCHITECTURE):
+  if len(target_architectures) != len(IOS_SUPPORT_ARCHITECTURE):
     # Need to override only if the archs are not default
     result_args.append("-DCMAKE_OSX_ARCHITECTURES=" +
-                       ";".join(g_target_architectures))
+                       ";".join(target_architectures))
 
   if len(devices) != len(SUPPORT_DEVICE):
     # Need to override if only passed in device or simulator
@@ -294,14 +307,36 @@ def get_ios_args(source_path):
                        "-"+IOS_CONFIG_DICT[devices[0]]["osx_sysroot"])
     result_args.append("-DIOS_PLATFORM_LOCATION=" +
                        IOS_CONFIG_DICT[devices[0]]["ios_platform_location"])
-  return result_args
+  return result_args, target_architectures
+
+
+@functools.lru_cache(maxsize=None)
+def find_android_toolchain_file(system_android_home):
+  """Find android.toolchain.cmake under the given Android SDK folder.
+
+    Args:
+      system_android_home: path of the Android SDK folder.
+    Returns:
+      Path of the toolchain file, or None if not found.
+  """
+  # The toolchain file only lives under ndk/<version> (or the legacy
+  # ndk-bundle), so look there directly instead of walking the whole SDK.
+  toolchain_files = glob.glob(os.path.join(
+      system_android_home, "ndk", "*", "build", "cmake",
+      "android.toolchain.cmake"))
+  if not toolchain_files:
+    toolchain_files = glob.glob(os.path.join(
+        system_android_home, "ndk-bundle", "build", "cmake",
+        "android.toolchain.cmake"))
+  return toolchain_files[0] if toolchain_files else None
 
 
 def get_android_args():
   """Get the cmake args for android platform specific.
 
     Returns:
-      camke args for android platform.
+      Tuple of (cmake args for android platform, list of target
+      architectures).
   """
   result_args = []
   # get Android NDK path
@@ -315,113 +350,365 @@ def get_android_args():
   else:
     system_android_home = os.getenv('ANDROID_HOME')
     if system_android_home:
-      toolchain_files = glob.glob(os.path.join(system_android_home,
-                                               "**", "build", "cmake", "android.toolchain.cmake"), recursive=True)
-      if toolchain_files:
-        result_args.append("-DCMAKE_TOOLCHAIN_FILE=" + toolchain_files[0])
+      toolchain_file = find_android_toolchain_file(system_android_home)
+      if not toolchain_file:
+        raise app.UsageError(
+            'Cannot find android.toolchain.cmake under ANDROID_HOME ({}).'.format(
+                system_android_home))
+      result_args.append("-DCMAKE_TOOLCHAIN_FILE=" + toolchain_file)
       logging.info("Use ANDROID_HOME(%s) cmake toolchain (%s)",
-                   system_android_home, toolchain_files[0])
+                   system_android_home, toolchain_file)
     else:
       raise app.UsageError(
           'Neither ANDROID_NDK_HOME nor ANDROID_HOME is set.')
 
   # get architecture setup
-  global g_target_architectures
   if FLAGS.architecture:
     for arch in FLAGS.architecture:
       if arch not in ANDROID_SUPPORT_ARCHITECTURE:
         raise app.UsageError(
             'Wrong architecture "{}", please pick from {}'.format(
                 arch, ",".join(ANDROID_SUPPORT_ARCHITECTURE)))
-    g_target_architectures = FLAGS.architecture
+    target_architectures = FLAGS.architecture
   else:
-    g_target_architectures = ANDROID_SUPPORT_ARCHITECTURE
+    target_architectures = ANDROID_SUPPORT_ARCHITECTURE
 
-  if len(g_target_architectures) == 1:
-    result_args.append("-DANDROID_ABI="+g_target_architectures[0])
+  if len(target_architectures) == 1:
+    result_args.append("-DANDROID_ABI="+target_architectures[0])
 
   result_args.append("-DFIREBASE_ANDROID_BUILD=true")
   # android default to build release.
   result_args.append("-DCMAKE_BUILD_TYPE=release")
   result_args.append("-DANDROID_STL=c++_shared")
-  return result_args
+  return result_args, target_architectures
+
+def read_raw_entry_data(src_zip, entry_info):
+  """Yield the stored (still compressed) bytes of a zip entry.
+     Reads straight from the archive's file object past the local header, so
+     the data is never inflated.
+
+    Args:
+      src_zip: open ZipFile to read the entry from.
+      entry_info: ZipInfo of the entry to read.
+
+    Yields:
+      Chunks of the entry's stored bytes.
+  """
+  src_stream = src_zip.fp
+  src_stream.seek(entry_info.header_offset)
+  header = src_stream.read(zipfile.sizeFileHeader)
+  if len(header) != zipfile.sizeFileHeader or \
+     header[:4] != zipfile.stringFileHeader:
+    raise zipfile.BadZipFile(
+        "Bad local file header for " + entry_info.filename)
+  name_length, extra_length = struct.unpack("<HH", header[26:30])
+  src_stream.seek(name_length + extra_length, os.SEEK_CUR)
+  remaining = entry_info.compress_size
+  while remaining > 0:
+    chunk = src_stream.read(min(ZIP_BUFFER_SIZE, remaining))
+    if not chunk:
+      raise zipfile.BadZipFile(
+          "Truncated entry data for " + entry_info.filename)
+    remaining -= len(chunk)
+    yield chunk
+
+def copy_zip_entry(src_zip, entry_info, dst_zip):
+  """Copy a single entry between two open zip files, transferring the stored
+     bytes untouched - no round trip through the filesystem, and no
+     inflate/re-deflate cycle.
+
+    Args:
+      src_zip: open ZipFile to read the entry from.
+      entry_info: ZipInfo of the entry to copy.
+      dst_zip: open (writable) ZipFile to copy the entry into.
+  """
+  dst_info = zipfile.ZipInfo(entry_info.filename,
+                             date_time=entry_info.date_time)
+  dst_info.compress_type = entry_info.compress_type
+  dst_info.external_attr = entry_info.external_attr
+  dst_info.internal_attr = entry_info.internal_attr
+  dst_info.create_system = entry_info.create_system
+  dst_info.CRC = entry_info.CRC
+  dst_info.compress_size = entry_info.compress_size
+  dst_info.file_size = entry_info.file_size
+  append_raw_entry(dst_zip, dst_info, read_raw_entry_data(src_zip, entry_info))
+
+def extract_zip_entry(zip_file, entry_info, dest_dir):
+  """Extract a single zip entry, streaming it through a large buffer.
+     ZipFile.extract writes through a small internal buffer, which costs many
+     syscalls per file on the big SDK payloads.
+
+    Args:
+      zip_file: open ZipFile to read the entry from.
+      entry_info: ZipInfo of the entry to extract; passing the ZipInfo avoids
+        another central directory lookup inside open().
+      dest_dir: folder to extract the entry into.
+
+    Returns:
+      Path of the extracted file.
+  """
+  dest_path = os.path.join(dest_dir, *entry_info.filename.split('/'))
+  os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+  with zip_file.open(entry_info) as src, \
+       open(dest_path, "wb", buffering=ZIP_BUFFER_SIZE) as dst:
+    shutil.copyfileobj(src, dst, ZIP_BUFFER_SIZE)
+  return dest_path
+
+def deflate_file_for_zip(fullpath, arcname):
+  """Read and deflate a single file for appending to a zip archive.
+     Runs in a worker process, so many files can be compressed in parallel.
+     The entry gets a constant timestamp instead of the file's mtime, so the
+     output zips are bit-identical across builds and no stat call is needed
+     per file.
+
+    Args:
+      fullpath: path of the file to deflate.
+      arcname: name the entry will have inside the archive.
+
+    Returns:
+      Tuple of (ZipInfo describing the entry, deflated bytes).
+  """
+  with open(fullpath, "rb", buffering=ZIP_BUFFER_SIZE) as source_file:
+    data = source_file.read()
+  # raw deflate stream, as stored in zip entries
+  compressor = zlib.compressobj(ZIP_COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+  compressed = compressor.compress(data) + compressor.flush()
+  entry_info = zipfile.ZipInfo(arcname.replace(os.sep, "/"),
+                               date_time=(1980, 1, 1, 0, 0, 0))
+  entry_info.external_attr = 0o644 << 16  # rw-r--r--
+  entry_info.compress_type = zipfile.ZIP_DEFLATED
+  entry_info.CRC = zlib.crc32(data)
+  entry_info.compress_size = len(compressed)
+  entry_info.file_size = len(data)
+  return entry_info, compressed
+
+def append_raw_entry(zip_file, entry_info, data_chunks):
+  """Append an entry whose stored bytes are already compressed to an open
+     ZipFile.
+
+     Writes the local header and the raw bytes directly, the same way
+     ZipFile.open(..., "w") would, but without running them through a
+     compressor again.
+
+    Args:
+      zip_file: open (writable) ZipFile to append to.
+      entry_info: ZipInfo with CRC, compress_size and file_size filled in.
+      data_chunks: iterable yielding the entry's stored bytes.
+  """
+  with zip_file._lock:
+    zip_file._writecheck(entry_info)
+    zip_file._didModify = True
+    zip_file.fp.seek(zip_file.start_dir)
+    entry_info.header_offset = zip_file.fp.tell()
+    zip64 = (entry_info.file_size > zipfile.ZIP64_LIMIT or
+             entry_info.compress_size > zipfile.ZIP64_LIMIT)
+    zip_file.fp.write(entry_info.FileHeader(zip64))
+    for chunk in data_chunks:
+      zip_file.fp.write(chunk)
+    zip_file.start_dir = zip_file.fp.tell()
+    zip_file.filelist.append(entry_info)
+    zip_file.NameToInfo[entry_info.filename] = entry_info
+
+def append_deflated_entry(zip_file, entry_info, compressed):
+  """Append an already-deflated entry to an open ZipFile.
+
+    Args:
+      zip_file: open (writable) ZipFile to append to.
+      entry_info: ZipInfo with CRC, compress_size and file_size filled in.
+      compressed: the raw deflated bytes of the entry.
+  """
+  append_raw_entry(zip_file, entry_info, (compressed,))
+
+def write_files_to_zip(zip_file, file_pairs):
+  """Add the given files to an open zip file, deflating in parallel.
+     Compression is the CPU bottleneck of the final archive step, so the
+     deflate work is fanned out to one worker process per core and only the
+     cheap raw append happens serially.
+
+    Args:
+      zip_file: open (writable) ZipFile to add the files to.
+      file_pairs: list of (fullpath, arcname) tuples to add.
+  """
+  if not file_pairs:
+    return
+  fullpaths, arcnames = zip(*file_pairs)
+  with concurrent.futures.ProcessPoolExecutor() as executor:
+    for entry_info, compressed in executor.map(
+        deflate_file_for_zip, fullpaths, arcnames):
+      append_deflated_entry(zip_file, entry_info, compressed)
+
+def write_folder_to_zip(zip_file, folder):
+  """Add every file under the given folder to an open zip file, deflating in
+     parallel.
+
+    Args:
+      zip_file: open (writable) ZipFile to add the files to.
+      folder: folder whose contents to add; arcnames are relative to it.
+  """
+  file_pairs = []
+  for current_root, _, filenames in os.walk(folder):
+    for filename in filenames:
+      fullpath = os.path.join(current_root, filename)
+      file_pairs.append((fullpath, os.path.relpath(fullpath, folder)))
+  write_files_to_zip(zip_file, file_pairs)
+
+def get_per_arch_jobs(arch_count):
+  """Split the core budget between concurrent per-arch builds, so combining
+     the outer arch parallelism with the inner 'cmake --build --parallel'
+     doesn't spawn arch_count * core_count compilers at once.
 
-def make_android_multi_arch_build(cmake_args, merge_script):
+    Args:
+      arch_count: number of architectures building concurrently.
+
+    Returns:
+      Job count for one architecture's build, as a string for argv use.
+  """
+  return str(max(1, multiprocessing.cpu_count() // max(1, arch_count)))
+
+def configure_if_needed(cmake_args, build_dir="."):
+  """Run the cmake configure step, unless the build folder already holds a
+     cache generated from the same arguments. The configure step alone takes
+     tens of seconds on the Firebase C++ SDK, so incremental builds skip it.
+     Clean builds bust the cache through get_build_path's rmtree.
+
+    Args:
+      cmake_args: full cmake configure arguments.
+      build_dir: folder to configure the project in.
+  """
+  config_hash = hashlib.sha256(
+      "\n".join(sorted(cmake_args)).encode("utf-8")).hexdigest()
+  hash_path = os.path.join(build_dir, ".config_hash")
+  if os.path.exists(os.path.join(build_dir, "CMakeCache.txt")) and \
+     os.path.exists(hash_path):
+    with open(hash_path) as hash_file:
+      if hash_file.read().strip() == config_hash:
+        logging.info("Skipping cmake configure, cache in %s is up to date",
+                     build_dir)
+        return
+  subprocess.run(cmake_args, cwd=build_dir, check=True)
+  with open(hash_path, "w") as hash_file:
+    hash_file.write(config_hash)
+
+def make_android_arch(arch, cmake_args, jobs):
+  """Make the android build for the given architecture.
+     Assumed to be called from the build directory. Runs in a worker process,
+     so it must stay picklable and raise on failure rather than share state.
+
+    Args:
+      arch: The architecture to build for.
+      cmake_args: Full cmake arguments to use, including the architecture
+        specific ones.
+      jobs: number of parallel compile jobs this architecture may use.
+  """
+  os.makedirs(arch, exist_ok=True)
+  build_dir = os.path.join(os.getcwd(), arch)
+  configure_if_needed(cmake_args, build_dir)
+  subprocess.run(["cmake", "--build", ".", "--parallel", jobs],
+                 cwd=build_dir, check=True)
+  subprocess.run(["cpack", "."], cwd=build_dir, check=True)
+
+def make_android_multi_arch_build(cmake_args, target_architectures,
+                                  merge_script):
   """Make android build for different architectures, and then combine them together.
 
     Args:
       cmake_args: cmake arguments used to build each architecture.
+      target_architectures: list of architectures to build for.
       merge_script: script path to merge the srcaar files.
   """
-  global g_target_architectures
+  # Import the merge module once and merge in-process, instead of paying the
+  # interpreter startup cost for a python subprocess per srcaar file.
+  sys.path.append(os.path.dirname(merge_script))
+  import merge_aar
+
   current_folder = os.getcwd()
-  # build multiple archictures
-  for arch in g_target_architectures:
-    if not os.path.exists(arch):
-      os.makedirs(arch)
-    build_dir = os.path.join(current_folder, arch)
-    cmake_args.append("-DANDROID_ABI="+arch)
-    subprocess.call(cmake_args, cwd=build_dir)
-    subprocess.call("make", cwd=build_dir)
-
-    cmake_pack_args = [
-      "cpack",
-      ".",
-    ]
-    subprocess.call(cmake_pack_args, cwd=build_dir)
+  # build multiple archictures in parallel, one worker process per arch
+  failed_archs = []
+  per_arch_jobs = get_per_arch_jobs(len(target_architectures))
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=len(target_architectures)) as executor:
+    arch_futures = {
+        executor.submit(make_android_arch, arch,
+                        cmake_args + ["-DANDROID_ABI="+arch],
+                        per_arch_jobs): arch
+        for arch in target_architectures}
+    for future in concurrent.futures.as_completed(arch_futures):
+      arch = arch_futures[future]
+      try:
+        future.result()
+      except subprocess.CalledProcessError as e:
+        logging.error("Android build failed for architecture %s: %s", arch, e)
+        failed_archs.append(arch)
+
+  if failed_archs:
+    logging.error("Skipping merge, android build failed for architectures: %s",
+                  ",".join(failed_archs))
+    return
 
   # merge them
-  zip_base_name = ""
-  srcarr_list = []
-  base_temp_dir = tempfile.mkdtemp()
-  for arch in g_target_architectures:
+  arch_zip_paths = []
+  for arch in target_architectures:
     # find *Android.zip in subfolder architecture
     arch_zip_path = glob.glob(os.path.join(arch, "*Android.zip"))
     if not arch_zip_path:
       logging.error("No *Android.zip generated for architecture %s", arch)
       return
-    if not zip_base_name:
-      # first architecture, so extract to the final temp folder. The following
-      # srcaar files will merge to the ones in this folder.
-      zip_base_name = arch_zip_path[0]
-      with zipfile.ZipFile(zip_base_name) as zip_file:
-        zip_file.extractall(base_temp_dir)
-      srcarr_list.extend(glob.glob(os.path.join(
-          base_temp_dir, "**", "*.srcaar"), recursive=True))
-    else:
+    arch_zip_paths.append(arch_zip_path[0])
+
+  # The first architecture is the base the other srcaar files merge into.
+  # Only the srcaar files need to touch the filesystem; every other entry of
+  # the base zip is copied straight into the final zip, so the bulk of the
+  # payload is no longer extracted and recompressed.
+  zip_base_name = arch_zip_paths[0]
+  base_temp_dir = tempfile.mkdtemp()
+  srcarr_list = []
+  final_zip_path = os.path.join(current_folder, os.path.basename(zip_base_name))
+  # 1 MiB buffers keep the entry copies from degrading into many small
+  # read/write syscalls.
+  with open(zip_base_name, "rb", buffering=ZIP_BUFFER_SIZE) as base_stream, \
+       open(final_zip_path, "wb", buffering=ZIP_BUFFER_SIZE) as final_stream, \
+       zipfile.ZipFile(base_stream) as base_zip, \
+       zipfile.ZipFile(final_stream, "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+                       compresslevel=ZIP_COMPRESSION_LEVEL,
+                       strict_timestamps=False) as final_zip:
+    for entry_info in base_zip.infolist():
+      if entry_info.filename.endswith('.srcaar'):
+        srcarr_list.append(extract_zip_entry(base_zip, entry_info,
+                                             base_temp_dir))
+      else:
+        copy_zip_entry(base_zip, entry_info, final_zip)
+
+    for arch_zip_path in arch_zip_paths[1:]:
       temporary_dir = tempfile.mkdtemp()
       # from the second *Android.zip, we only need to extract *.srcaar files to operate the merge.
-      with zipfile.ZipFile(arch_zip_path[0]) as zip_file:
-        for file in zip_file.namelist():
-          if file.endswith('.srcaar'):
-            zip_file.extract(file, temporary_dir)
+      with open(arch_zip_path, "rb", buffering=ZIP_BUFFER_SIZE) as arch_stream, \
+           zipfile.ZipFile(arch_stream) as zip_file:
+        for entry_info in zip_file.infolist():
+          if entry_info.filename.endswith('.srcaar'):
+            extract_zip_entry(zip_file, entry_info, temporary_dir)
             logging.debug("Unpacked file %s from zip file %s to %s",
-                          file, arch_zip_path, temporary_dir)
+                          entry_info.filename, arch_zip_path, temporary_dir)
 
-      for srcaar_file in srcarr_list:
-        srcaar_name = os.path.basename(srcaar_file)
-        matching_files = glob.glob(os.path.join(
-            temporary_dir, "**", "*"+srcaar_name), recursive=True)
-        if matching_files:
-          merge_args = [
-              "python",
-              merge_script,
-              "--inputs=" + srcaar_file,
-              "--inputs=" + matching_files[0],
-              "--output=" + srcaar_file,
-          ]
-          subprocess.call(merge_args)
-          logging.debug("merging %s to %s", matching_files[0], srcaar_file)
+      # index the extracted files by basename once, rather than running a
+      # recursive glob over the temp folder for every srcaar.
+      extracted_files = {}
+      for extracted_root, _, filenames in os.walk(temporary_dir):
+        for filename in filenames:
+          extracted_files[filename] = os.path.join(extracted_root, filename)
 
-  # achive the temp folder to the final firebase_unity-<version>-Android.zip
-  final_zip_path = os.path.join(current_folder, os.path.basename(zip_base_name))
-  with zipfile.ZipFile(final_zip_path, "w", allowZip64=True) as zip_file:
-    for current_root, _, filenames in os.walk(base_temp_dir):
-      for filename in filenames:
-        fullpath = os.path.join(current_root, filename)
-        zip_file.write(fullpath, os.path.relpath(fullpath, base_temp_dir))
+      for srcaar_file in srcarr_list:
+        matching_file = extracted_files.get(os.path.basename(srcaar_file))
+        if matching_file:
+          merge_aar.merge([srcaar_file, matching_file], srcaar_file)
+          logging.debug("merging %s to %s", matching_file, srcaar_file)
+
+    # add the merged srcaar files to the final
+    # firebase_unity-<version>-Android.zip
+    write_files_to_zip(final_zip, [
+        (srcaar_file, os.path.relpath(srcaar_file, base_temp_dir))
+        for srcaar_file in srcarr_list])
   logging.info("Generated Android multi-arch (%s) zip %s",
-               ",".join(g_target_architectures), final_zip_path)
+               ",".join(target_architectures), final_zip_path)
 
 def get_windows_args():
   """Get the cmake args for windows platform specific.
@@ -430,8 +717,10 @@ def get_windows_args():
       cmake args for windows platform.
   """
   result_args = []
-  result_args.append('-G Visual Studio 16 2019')
-  result_args.append('-A x64') # TODO flexibily for x32
+  # generator and platform need to be separate argv entries; a single
+  # "-G Visual Studio 16 2019" string reaches cmake as one malformed arg
+  result_args.extend(['-G', 'Visual Studio 16 2019'])
+  result_args.extend(['-A', 'x64']) # TODO flexibily for x32
   result_args.append("-DFIREBASE_PYTHON_HOST_EXECUTABLE:FILEPATH=%s" % sys.executable)
   # Use a newer version of the Windows SDK, as the default one has build issues with grpc
   if FLAGS.gha:
@@ -442,113 +731,146 @@ def get_macos_args():
   """Get the cmake args for macos platform specific.
 
     Returns:
-      cmake args for macos platform.
+      Tuple of (cmake args for macos platform, list of target architectures).
   """
   result_args = []
-  global g_target_architectures
-  # get architecture setup global g_target_architectures
+  # get architecture setup
   if FLAGS.architecture:
     for arch in FLAGS.architecture:
       if arch not in MACOS_SUPPORT_ARCHITECTURE:
         raise app.UsageError(
             'Wrong architecture "{}", please pick from {}'.format(
                 arch, ",".join(MACOS_SUPPORT_ARCHITECTURE)))
-    g_target_architectures = FLAGS.architecture
+    target_architectures = FLAGS.architecture
   else:
     # Default to selecting none, as it will likely only be able to build the local architecture.
-    g_target_architectures = []
-  if len(g_target_architectures) == 1:
-    result_args.append('-DCMAKE_OSX_ARCHITECTURES='+g_target_architectures[0])
-  
-  return result_args
+    target_architectures = []
+  if len(target_architectures) == 1:
+    result_args.append('-DCMAKE_OSX_ARCHITECTURES='+target_architectures[0])
 
-def make_macos_arch(arch, cmake_args):
+  return result_args, target_architectures
+
+def make_macos_arch(arch, cmake_args, jobs):
   """Make the macos build for the given architecture.
-     Assumed to be called from the build directory.
+     Assumed to be called from the build directory. Runs in a worker process,
+     so it must stay picklable and raise on failure rather than share state.
 
     Args:
       arch: The architecture to build for.
-      cmake_args: Additional cmake arguments to use.
+      cmake_args: Full cmake arguments to use, including the architecture
+        specific ones.
+      jobs: number of parallel compile jobs this architecture may use.
   """
-  if not os.path.exists(arch):
-    os.makedirs(arch)
+  os.makedirs(arch, exist_ok=True)
   build_dir = os.path.join(os.getcwd(), arch)
-  cmake_args.append('-DCMAKE_OSX_ARCHITECTURES='+arch)
-  subprocess.call(cmake_args, cwd=build_dir)
-  subprocess.call('make', cwd=build_dir)
-  subprocess.call(['cpack', '.'], cwd=build_dir)
+  configure_if_needed(cmake_args, build_dir)
+  subprocess.run(['cmake', '--build', '.', '--parallel', jobs],
+                 cwd=build_dir, check=True)
+  subprocess.run(['cpack', '.'], cwd=build_dir, check=True)
 
-def make_macos_multi_arch_build(cmake_args):
+def make_macos_multi_arch_build(cmake_args, target_architectures):
   """Make macos build for different architectures, and then combine them together
 
     Args:
       cmake_args: cmake arguments used to build each architecture.
+      target_architectures: list of architectures to build for.
   """
-  global g_target_architectures
   # build multiple architectures
   current_folder = os.getcwd()
-  threads = []
-  for arch in g_target_architectures:
-    t = threading.Thread(target=make_macos_arch, args=(arch, cmake_args))
-    t.start()
-    threads.append(t)
+  failed_archs = []
+  per_arch_jobs = get_per_arch_jobs(len(target_architectures))
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=len(target_architectures)) as executor:
+    arch_futures = {
+        executor.submit(make_macos_arch, arch,
+                        cmake_args + ['-DCMAKE_OSX_ARCHITECTURES='+arch],
+                        per_arch_jobs): arch
+        for arch in target_architectures}
+    for future in concurrent.futures.as_completed(arch_futures):
+      arch = arch_futures[future]
+      try:
+        future.result()
+      except subprocess.CalledProcessError as e:
+        logging.error("MacOS build failed for architecture %s: %s", arch, e)
+        failed_archs.append(arch)
+
+  if failed_archs:
+    logging.error("Skipping merge, macos build failed for architectures: %s",
+                  ",".join(failed_archs))
+    return
 
-  for t in threads:
-    t.join()
-  
   # Merge the different zip files together, using lipo on the bundle files
-  zip_base_name = ""
-  bundle_list = []
-  base_temp_dir = tempfile.mkdtemp()
-  for arch in g_target_architectures:
+  arch_zip_paths = []
+  for arch in target_architectures:
     # find *Darwin.zip in subfolder architecture
     arch_zip_path = glob.glob(os.path.join(arch, "*Darwin.zip"))
     if not arch_zip_path:
       logging.error("No *Darwin.zip generated for architecture %s", arch)
       return
-    if not zip_base_name:
-      # first architecture, so extract to the final temp folder. The following
-      # bundle files will merge to the ones in this folder.
-      zip_base_name = arch_zip_path[0]
-      with zipfile.ZipFile(zip_base_name) as zip_file:
-        zip_file.extractall(base_temp_dir)
-      bundle_list.extend(glob.glob(os.path.join(
-          base_temp_dir, "**", "*.bundle"), recursive=True))
-    else:
+    arch_zip_paths.append(arch_zip_path[0])
+
+  # The first architecture is the base the other bundle files merge into.
+  # Only the bundle files need to touch the filesystem; every other entry of
+  # the base zip is copied straight into the final zip, so the bulk of the
+  # payload is no longer extracted and recompressed.
+  zip_base_name = arch_zip_paths[0]
+  base_temp_dir = tempfile.mkdtemp()
+  bundle_list = []
+  final_zip_path = os.path.join(current_folder, os.path.basename(zip_base_name))
+  # 1 MiB buffers keep the entry copies from degrading into many small
+  # read/write syscalls.
+  with open(zip_base_name, "rb", buffering=ZIP_BUFFER_SIZE) as base_stream, \
+       open(final_zip_path, "wb", buffering=ZIP_BUFFER_SIZE) as final_stream, \
+       zipfile.ZipFile(base_stream) as base_zip, \
+       zipfile.ZipFile(final_stream, "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+                       compresslevel=ZIP_COMPRESSION_LEVEL,
+                       strict_timestamps=False) as final_zip:
+    for entry_info in base_zip.infolist():
+      if entry_info.filename.endswith('.bundle'):
+        bundle_list.append(extract_zip_entry(base_zip, entry_info,
+                                             base_temp_dir))
+      else:
+        copy_zip_entry(base_zip, entry_info, final_zip)
+
+    for arch_zip_path in arch_zip_paths[1:]:
       temporary_dir = tempfile.mkdtemp()
       # from the second *Darwin.zip, we only need to extract *.bundle files to operate the merge.
-      with zipfile.ZipFile(arch_zip_path[0]) as zip_file:
-        for file in zip_file.namelist():
-          if file.endswith('.bundle'):
-            zip_file.extract(file, temporary_dir)
+      with open(arch_zip_path, "rb", buffering=ZIP_BUFFER_SIZE) as arch_stream, \
+           zipfile.ZipFile(arch_stream) as zip_file:
+        for entry_info in zip_file.infolist():
+          if entry_info.filename.endswith('.bundle'):
+            extract_zip_entry(zip_file, entry_info, temporary_dir)
             logging.debug("Unpacked file %s from zip file %s to %s",
-                          file, arch_zip_path, temporary_dir)
+                          entry_info.filename, arch_zip_path, temporary_dir)
+
+      # index the extracted files by basename once, rather than running a
+      # recursive glob over the temp folder for every bundle.
+      extracted_files = {}
+      for extracted_root, _, filenames in os.walk(temporary_dir):
+        for filename in filenames:
+          extracted_files[filename] = os.path.join(extracted_root, filename)
 
       for bundle_file in bundle_list:
-        bundle_name = os.path.basename(bundle_file)
-        matching_files = glob.glob(os.path.join(
-            temporary_dir, "**", "*"+bundle_name), recursive=True)
-        if matching_files:
+        matching_file = extracted_files.get(os.path.basename(bundle_file))
+        if matching_file:
           merge_args = [
               "lipo",
               bundle_file,
-              matching_files[0],
+              matching_file,
               "-create",
               "-output",
               bundle_file,
           ]
-          subprocess.call(merge_args)
-          logging.debug("merging %s to %s", matching_files[0], bundle_file)
-
-  # achive the temp folder to the final firebase_unity-<version>-Darwin.zip
-  final_zip_path = os.path.join(current_folder, os.path.basename(zip_base_name))
-  with zipfile.ZipFile(final_zip_path, "w", allowZip64=True) as zip_file:
-    for current_root, _, filenames in os.walk(base_temp_dir):
-      for filename in filenames:
-        fullpath = os.path.join(current_root, filename)
-        zip_file.write(fullpath, os.path.relpath(fullpath, base_temp_dir))
+          subprocess.run(merge_args, check=True)
+          logging.debug("merging %s to %s", matching_file, bundle_file)
+
+    # add the merged bundle files to the final
+    # firebase_unity-<version>-Darwin.zip
+    write_files_to_zip(final_zip, [
+        (bundle_file, os.path.relpath(bundle_file, base_temp_dir))
+        for bundle_file in bundle_list])
   logging.info("Generated Darwin (MacOS) multi-arch (%s) zip %s",
-               ",".join(g_target_architectures), final_zip_path)
+               ",".join(target_architectures), final_zip_path)
 
 
 def configure_tvos_target(device, arch, cmake_args):
@@ -574,19 +896,19 @@ def configure_tvos_target(device, arch, cmake_args):
   build_args.append("-DPLATFORM=" +
                        TVOS_CONFIG_DICT[device]["toolchain_platform"])
 
-  if not os.path.exists(arch):
-    os.makedirs(arch)
+  os.makedirs(arch, exist_ok=True)
   build_dir = os.path.join(os.getcwd(), arch)
   subprocess.call(build_args, cwd=build_dir)
   return build_dir
 
-def make_tvos_target(build_dir):
+def make_tvos_target(build_dir, jobs):
   """Builds the previously configured cmake project in the given directory.
 
     Args:
-      The full path to the directory to perform the build in.
+      build_dir: The full path to the directory to perform the build in.
+      jobs: number of parallel compile jobs this build may use.
   """
-  subprocess.call('make', cwd=build_dir)
+  subprocess.call(['cmake', '--build', '.', '--parallel', jobs], cwd=build_dir)
   subprocess.call(['cpack', '.'], cwd=build_dir)
 
 def make_tvos_multi_arch_build(cmake_args):
@@ -601,15 +923,18 @@ def make_tvos_multi_arch_build(cmake_args):
   target_architectures = []
 
   # build multiple architectures
-  current_folder = os.getcwd()
   threads = []
+  per_arch_jobs = get_per_arch_jobs(
+      sum(len(TVOS_CONFIG_DICT[device]["architecture"])
+          for device in g_target_devices))
   for device in g_target_devices:
     for arch in TVOS_CONFIG_DICT[device]["architecture"]:
       target_architectures.append(arch)
       # Run the configure step sequentially, since they can clobber the shared Cocoapod cache
       build_dir = configure_tvos_target(device, arch, cmake_args)
       # Run the builds in parallel, since they can be
-      t = threading.Thread(target=make_tvos_target, args=(build_dir,))
+      t = threading.Thread(target=make_tvos_target,
+                           args=(build_dir, per_arch_jobs))
       t.start()
       threads.append(t)
 
@@ -639,9 +964,9 @@ def make_tvos_multi_arch_build(cmake_args):
       temporary_dir = tempfile.mkdtemp()
       # from the second *-tvOS.zip, we only need to extract *.a files to operate the merge.
       with zipfile.ZipFile(arch_zip_path[0]) as zip_file:
-        for file in zip_file.namelist():
-          if file.endswith('.a'):
-            zip_file.extract(file, temporary_dir)
+        for entry_info in zip_file.infolist():
+          if entry_info.filename.endswith('.a'):
+            extract_zip_entry(zip_file, entry_info, temporary_dir)
 
       for library_file in library_list:
         library_name = os.path.basename(library_file)
@@ -661,13 +986,13 @@ def make_tvos_multi_arch_build(cmake_args):
 
   # archive the temp folder to the final firebase_unity-<version>-tvOS.zip
   final_zip_path = os.path.join(current_folder, os.path.basename(zip_base_name))
-  with zipfile.ZipFile(final_zip_path, "w", allowZip64=True) as zip_file:
-    for current_root, _, filenames in os.walk(base_temp_dir):
-      for filename in filenames:
-        fullpath = os.path.join(current_root, filename)
-        zip_file.write(fullpath, os.path.relpath(fullpath, base_temp_dir))
+  with open(final_zip_path, "wb", buffering=ZIP_BUFFER_SIZE) as final_stream, \
+       zipfile.ZipFile(final_stream, "w", zipfile.ZIP_DEFLATED, allowZip64=True,
+                       compresslevel=ZIP_COMPRESSION_LEVEL,
+                       strict_timestamps=False) as zip_file:
+    write_folder_to_zip(zip_file, base_temp_dir)
   logging.info("Generated Darwin (tvOS) multi-arch (%s) zip %s",
-               ",".join(g_target_architectures), final_zip_path)
+               ",".join(target_architectures), final_zip_path)
 
 def gen_documentation_zip():
   """If the flag was enabled, builds the zip file containing source files to document.
@@ -733,13 +1058,17 @@ def main(argv):
     raise app.UsageError('Wrong platform "{}", please pick from {}'.format(
         platform, ",".join(SUPPORT_PLATFORMS)))
 
+  # Let nested cmake invocations (e.g. external project builds) inherit the
+  # same parallelism as the top-level build.
+  os.environ["CMAKE_BUILD_PARALLEL_LEVEL"] = JOBS
+
   source_path = os.getcwd()
-  cmake_cpp_folder_args = get_cpp_folder_args(source_path)
+  cpp_sdk_realpath, cmake_cpp_folder_args = get_cpp_folder_args(source_path)
   build_path = get_build_path(platform, FLAGS.clean_build)
-  if is_android_build() and g_cpp_sdk_realpath:
+  if is_android_build() and cpp_sdk_realpath:
     # For android build, if we find local cpp folder,
     # We trigger the cpp android build first.
-    subprocess.call("./gradlew", cwd=g_cpp_sdk_realpath)
+    subprocess.run("./gradlew", cwd=cpp_sdk_realpath, check=True)
 
   os.chdir(build_path)
   cmake_setup_args = [
@@ -793,48 +1122,55 @@ def main(argv):
   else:
     cmake_setup_args.append("-DFIREBASE_USE_BORINGSSL=OFF")
 
+  target_architectures = []
   if is_ios_build():
-    cmake_setup_args.extend(get_ios_args(source_path))
+    ios_args, target_architectures = get_ios_args(source_path)
+    cmake_setup_args.extend(ios_args)
   elif is_tvos_build():
     cmake_setup_args.extend(get_tvos_args(source_path))
   elif is_android_build():
-    cmake_setup_args.extend(get_android_args())
+    android_args, target_architectures = get_android_args()
+    cmake_setup_args.extend(android_args)
   elif is_macos_build():
-    cmake_setup_args.extend(get_macos_args())
+    macos_args, target_architectures = get_macos_args()
+    cmake_setup_args.extend(macos_args)
 
   if FLAGS.gen_swig_only:
     cmake_setup_args.append("-DFIREBASE_GENERATE_SWIG_ONLY=ON")
 
-  global g_target_architectures
-  logging.info("cmake_setup_args is: " + " ".join(cmake_setup_args))
-  if is_android_build() and len(g_target_architectures) > 1:
+  logging.info("cmake_setup_args is: %s", " ".join(cmake_setup_args))
+  if is_android_build() and len(target_architectures) > 1:
     logging.info("Build android with multiple architectures %s",
-                 ",".join(g_target_architectures))
+                 ",".join(target_architectures))
     # android multi architecture build is a bit different
-    make_android_multi_arch_build(cmake_setup_args, os.path.join(
-        source_path, "aar_builder", "merge_aar.py"))
-  elif is_macos_build() and len(g_target_architectures) > 1:
+    make_android_multi_arch_build(cmake_setup_args, target_architectures,
+                                  os.path.join(
+                                      source_path, "aar_builder", "merge_aar.py"))
+  elif is_macos_build() and len(target_architectures) > 1:
     logging.info("Build macos with multiple architectures %s",
-                 ",".join(g_target_architectures))
-    make_macos_multi_arch_build(cmake_setup_args)
+                 ",".join(target_architectures))
+    make_macos_multi_arch_build(cmake_setup_args, target_architectures)
   elif is_tvos_build():
     make_tvos_multi_arch_build(cmake_setup_args)
   else:
-    subprocess.call(cmake_setup_args)
+    configure_if_needed(cmake_setup_args)
     if (not FLAGS.gen_swig_only):
       if is_windows_build():
         # no make command in windows. TODO make config passable
-        subprocess.call("cmake --build .  --config Release")
+        subprocess.run(
+            ["cmake", "--build", ".", "--config", "Release", "--parallel", JOBS],
+            check=True)
       else:
-        subprocess.call("make")
+        subprocess.run(["cmake", "--build", ".", "--parallel", JOBS], check=True)
 
       cmake_pack_args = [
         "cpack",
         ".",
       ]
-      subprocess.call(cmake_pack_args)
+      subprocess.run(cmake_pack_args, check=True)
     else:
-      subprocess.call(["cmake", "--build", ".", "--target", "firebase_swig_targets"])
+      subprocess.run(["cmake", "--build", ".", "--target", "firebase_swig_targets"],
+                     check=True)
 
     gen_documentation_zip()
 